@@ -0,0 +1,209 @@
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import completions
+import grid
+import grid_grading
+import grid_questions
+
+# Benchmarks that run without a network connection. Completions come from canned responses.
+
+canned_grid_responses = [
+    ' Yes',
+    ' No',
+    ' 12',
+    ' A wall tile',
+    ' A floor tile',
+    ' The agent',
+    ' The goal tile',
+    " In the context of Grid World, I don't have any information about that.",
+    ' It depends.',
+]
+
+def fake_grid_backend(**kwargs):
+    # Deterministic for a given prompt so runs are comparable
+    rng = random.Random(kwargs['prompt'])
+    texts = [rng.choice(canned_grid_responses) for _ in range(kwargs.get('n', 1))]
+    return completions.Completion(texts, prompt_tokens=len(kwargs['prompt']) // 4, completion_tokens=4)
+
+def fake_db_backend(**kwargs):
+    # Ask about everybody's age or relative order, then answer
+    prompt = kwargs['prompt']
+    session = prompt[prompt.rindex('SESSION 2'):]
+    steps = session.count('User:')
+    if 'list_animals()' in session:
+        script = ['list_animals()', 'has_more_legs(pratchett, scuttle)', 'has_more_legs(scuttle, pratchett)', 'the_answer_is(scuttle)']
+    elif 'is_older(' in session:
+        script = ['list_people()', 'is_older(alice, bob)', 'is_older(bob, alice)', 'the_answer_is(alice)']
+    else:
+        script = ['list_people()', 'age(alice)', 'age(bob)', 'the_answer_is(bob)']
+    text = ' ' + script[min(steps, len(script)) - 1]
+    return completions.Completion([text], prompt_tokens=len(prompt) // 4, completion_tokens=len(text) // 4)
+
+class Counted:
+    """Wraps a backend to count the completion requests made through it"""
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        return self.backend(**kwargs)
+
+def peak_rss_kb() -> int:
+    """Peak resident set size of this process so far. Each phase runs in a fresh process, so this is per phase."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+class Phase:
+    def __init__(self, name: str, results: dict):
+        self.name = name
+        self.results = results
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+        entry = self.results.setdefault(self.name, {})
+        entry['seconds'] = elapsed
+        entry['cpu_seconds'] = time.process_time() - self.cpu0
+        entry['peak_rss_kb'] = peak_rss_kb()
+        if 'items' in entry:
+            entry['items_per_second'] = entry['items'] / elapsed if elapsed > 0 else None
+
+def bench_generate(results: dict, repeat: int):
+    with Phase('generate', results):
+        n = 0
+        for _ in range(repeat):
+            n += len(grid_questions.get_quiz([{'model':'bench', 'max_tokens':80, 'temperature':0, 'n':1}])['questions'])
+        results['generate'] = {'items': n}
+
+def bench_ask(results: dict, workdir: str, schema, samples: int):
+    filename = os.path.join(workdir, 'ask.json')
+    params = {'model':'bench', 'max_tokens':80, 'temperature':0, 'n':samples}
+    quiz = grid_questions.get_quiz([params])
+    with open(filename, 'w') as f:
+        json.dump(quiz, f)
+    completions.set_backend(fake_grid_backend)
+    with Phase('ask', results):
+        results['ask'] = {'items': len(quiz['questions'])}
+        grid.ask_questions(filename, f'{filename}.old', [params], schema)
+
+def synthetic_results(size: int, seed: int = 0) -> dict:
+    """A quiz with at least size questions, all answered with canned responses"""
+    rng = random.Random(seed)
+    quiz = grid_questions.get_quiz([{'model':'bench', 'max_tokens':80, 'temperature':0, 'n':1}])
+    template = quiz['questions']
+    questions = []
+    while len(questions) < size:
+        for q in template:
+            q = dict(q)
+            q['runs'] = [dict(run, response=rng.choice(canned_grid_responses)) for run in q['runs']]
+            questions.append(q)
+    quiz['questions'] = questions
+    return quiz
+
+def bench_grade(results: dict, size: int, jobs: int):
+    data = synthetic_results(size)
+    name = f'grade_jobs_{jobs}'
+    with Phase(name, results):
+        results[name] = {'items': len(data['questions'])}
+        grid_grading.grade(data, 0, jobs)
+
+def bench_db(results: dict, max_interactions: int):
+    import db
+    backend = Counted(fake_db_backend)
+    completions.set_backend(backend)
+    # Every assignment of ages rather than just the distinct orderings, to get a wide tree
+    spec = db.WorldSpec(db.AgeDb, ['alice', 'bob'], list(range(20, 80, 7)), pick = 'lowest', order_only = False)
+    dbs, answers = spec.worlds()
+    with Phase('db_multi_session', results):
+        db.multi_session(
+            theme = 'bench',
+            question = "Who is the youngest? Available commands: list_people(), age(Person), the_answer_is(Person_or_Unknown).",
+            dbs = dbs,
+            answers = answers,
+            max_interactions = max_interactions,
+        )
+        results['db_multi_session'] = {'items': backend.calls}
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def run_phase(phase: str, arg, args, schema, workdir: str) -> dict:
+    """Run one benchmark phase, in its own process (see main), and return its results"""
+    results = {}
+    os.chdir(workdir)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if phase == 'generate':
+            bench_generate(results, args.quizzes)
+        elif phase == 'ask':
+            bench_ask(results, workdir, schema, args.samples)
+        elif phase == 'grade':
+            bench_grade(results, args.grade_size, arg)
+        elif phase == 'db':
+            bench_db(results, args.max_interactions)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--phases', type=str, nargs='*', default=['generate', 'ask', 'grade', 'db'], help='Which benchmarks to run (default generate ask grade db)')
+    parser.add_argument('--quizzes', type=int, default=200, help='Number of quizzes to generate (default 200)')
+    parser.add_argument('--grade-size', type=int, default=200000, help='Number of synthetic answered questions to grade (default 200000)')
+    parser.add_argument('--jobs', type=int, nargs='*', default=[1, 4], help='Grading worker process counts to try (default 1 4)')
+    parser.add_argument('--samples', type=int, default=1, help='Samples per question when asking (default 1)')
+    parser.add_argument('--max-interactions', type=int, default=5, help='Depth of the db session tree (default 5)')
+    parser.add_argument('--output', type=str, help='Write the JSON results to this file as well as stdout')
+    args = parser.parse_args()
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grid_schema.json')) as f:
+        schema = json.load(f)
+
+    tasks = []
+    for phase in ['generate', 'ask', 'grade', 'db']:
+        if phase in args.phases:
+            tasks += [(phase, j) for j in args.jobs] if phase == 'grade' else [(phase, None)]
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='aitest-bench-')
+    try:
+        # A fresh (spawned, not forked) process per phase, so peak memory isn't carried over from earlier phases
+        # (Not a multiprocessing.Pool, whose daemonic workers couldn't start the grading pool)
+        context = multiprocessing.get_context('spawn')
+        for phase, arg in tasks:
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                results.update(executor.submit(run_phase, phase, arg, args, schema, workdir).result())
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'phases': results,
+    }
+    text = json.dumps(report, indent=4)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import os
+from typing import Optional
+
+import metrics
+
+class Choice:
+    def __init__(self, text: str, index: int = 0):
+        self.text = text
+        self.index = index
+
+class Completion:
+    """The parts of an OpenAI completion response that the rest of the code uses"""
+    def __init__(self, texts: list[str], prompt_tokens: int = 0, completion_tokens: int = 0):
+        self.choices = [Choice(text, i) for i, text in enumerate(texts)]
+        self.usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+
+def openai_backend(**kwargs):
+    import openai
+    if openai.api_key == None:
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+    return openai.Completion.create(**kwargs)
+
+_backend = openai_backend
+
+# (backend name, model) -> backend, so that a local model is only loaded once per process
+_backends = {('openai', None): openai_backend}
+
+def set_backend(backend):
+    """
+    Replace the function that completions are requested from. It is called with the same keyword
+    arguments as openai.Completion.create and should return something shaped like a Completion.
+    """
+    global _backend
+    _backend = backend
+
+def configure(backend: Optional[str] = None, local_model: Optional[str] = None):
+    """
+    Choose the backend by name: openai (the default) or local, which runs a transformers model
+    on the CPU (see local_backend.py). Defaults come from the AITEST_BACKEND and
+    AITEST_LOCAL_MODEL environment variables.
+    """
+    backend = backend or os.getenv('AITEST_BACKEND') or 'openai'
+    if backend == 'openai':
+        key = ('openai', None)
+    elif backend == 'local':
+        import local_backend
+        key = ('local', local_model or os.getenv('AITEST_LOCAL_MODEL') or local_backend.default_model)
+        if key not in _backends:
+            _backends[key] = local_backend.LocalBackend(key[1])
+    else:
+        raise Exception(f"Unknown backend {backend}")
+    set_backend(_backends[key])
+
+def create(**kwargs):
+    with metrics.span('request', model=kwargs.get('model'), n=kwargs.get('n', 1)) as attrs:
+        completion = _backend(**kwargs)
+        metrics.record_usage(completion, attrs)
+    return completion
@@ -0,0 +1,178 @@
+import argparse
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+# A long-lived worker that keeps imports, the schema, parsed data files and completion clients
+# warm between runs. Jobs are the same command lines as grid.py or db.py, submitted over a
+# local Unix socket, and their output is streamed back to the client as it's printed.
+#
+#   python daemon.py serve &
+#   python daemon.py submit grid --ask --grade
+#   python daemon.py submit theme legs_comparison
+#
+# Jobs run one at a time, because they print through the process-wide stdout and may write the
+# same data files.
+
+default_socket = os.path.join(os.getenv('XDG_RUNTIME_DIR') or '/tmp', f'aitest-{os.getuid()}.sock')
+
+class SocketWriter:
+    """A text stream that sends each write to the client as a JSON line"""
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text: str) -> int:
+        if text:
+            send(self.wfile, {'output': text})
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+def send(wfile, message: dict):
+    wfile.write((json.dumps(message) + '\n').encode())
+    wfile.flush()
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        job = json.loads(self.rfile.readline())
+        out = SocketWriter(self.wfile)
+        error = None
+        cwd = os.getcwd()
+        try:
+            os.chdir(job['cwd'])
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                run_job(self.server.schema, job['kind'], job['args'], job.get('env', {}))
+        except BrokenPipeError:
+            return
+        except BaseException as e:
+            # Includes SystemExit from argparse, which shouldn't take the daemon down
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            if not isinstance(e, SystemExit):
+                out.write(traceback.format_exc())
+        finally:
+            os.chdir(cwd)
+        try:
+            send(self.wfile, {'done': True, 'error': error})
+        except BrokenPipeError:
+            pass
+
+@contextlib.contextmanager
+def job_environment(env: dict):
+    """Use the client's AITEST_* environment variables, instead of the daemon's, for the duration of a job"""
+    saved = {name: value for name, value in os.environ.items() if name.startswith('AITEST_')}
+    for name in saved:
+        del os.environ[name]
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for name in env:
+            os.environ.pop(name, None)
+        os.environ.update(saved)
+
+def run_job(schema, kind: str, args: list[str], env: dict):
+    import completions
+    import db
+    import grid
+    import metrics
+    # The backend and metrics are process-wide, so every job sets them up afresh rather than
+    # inheriting them from the last one. Trace and metrics filenames are relative to the client's directory.
+    with job_environment(env):
+        try:
+            metrics.reset()
+            if kind == 'grid':
+                parsed = grid.make_parser().parse_args(args)
+                metrics.configure(trace=parsed.trace, prometheus=parsed.metrics)
+                completions.configure(parsed.backend, parsed.local_model)
+                grid.run(parsed, schema)
+            elif kind == 'theme':
+                if len(args) != 1:
+                    raise Exception("A theme job takes exactly one theme name")
+                metrics.configure()
+                completions.configure()
+                db.run_theme(args[0])
+            else:
+                raise Exception(f"Unknown job kind {kind}")
+        finally:
+            metrics.finish()
+            metrics.reset()
+
+def serve(path: str):
+    # Pay for all the imports and loading up front
+    import jsonschema
+    import completions
+    import db
+    import grid
+    import grid_grading
+    import grid_questions
+    import metrics
+    try:
+        import openai
+    except ImportError:
+        pass
+    completions.configure()
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grid_schema.json')) as f:
+        schema = json.load(f)
+
+    if os.path.exists(path):
+        # Only remove the socket if it's left over from a daemon that has gone away
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                pass
+            else:
+                raise Exception(f"A daemon is already listening on {path}")
+        os.unlink(path)
+    with socketserver.UnixStreamServer(path, JobHandler) as server:
+        server.schema = schema
+        print(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+def submit(path: str, kind: str, args: list[str]) -> int:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        env = {name: value for name, value in os.environ.items() if name.startswith('AITEST_')}
+        sock.sendall((json.dumps({'kind': kind, 'args': args, 'cwd': os.getcwd(), 'env': env}) + '\n').encode())
+        with sock.makefile('rb') as f:
+            for line in f:
+                message = json.loads(line)
+                if 'output' in message:
+                    sys.stdout.write(message['output'])
+                    sys.stdout.flush()
+                elif message.get('done'):
+                    if message['error'] != None:
+                        print(message['error'], file=sys.stderr)
+                        return 1
+                    return 0
+    print("Connection closed before the job finished", file=sys.stderr)
+    return 1
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, default=default_socket, help=f'Unix socket path (default {default_socket})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('serve', help='Run the daemon')
+    submit_parser = subparsers.add_parser('submit', help='Submit a job and stream its output')
+    submit_parser.add_argument('kind', choices=['grid', 'theme'], help='grid takes grid.py arguments (--generate, --ask, --grade, ...), theme takes a db.py theme name')
+    submit_parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments for the job')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket)
+    else:
+        sys.exit(submit(args.socket, args.kind, args.args))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,15 @@
+import argparse
 from datetime import datetime
 import html
-import openai
+import itertools
 import os
 import re
-import sys
-from typing import Optional
+from typing import Iterator, Optional
+
+import completions
+import metrics
+import planning
 
-os.makedirs('auto_transcripts', exist_ok=True)
-openai.api_key = os.getenv("OPENAI_API_KEY")
 max_tokens = 60
 model = 'text-davinci-003'
 
@@ -60,6 +62,9 @@ class AgeDb:
     def __init__(self, **ages):
         self.ages = ages
 
+    def queries(self) -> list[str]:
+        return ['list_people()'] + [f'age({a})' for a in self.ages]
+
     def query(self, q: str) -> str:
         m = re_list_people.match(q)
         if m:
@@ -73,6 +78,9 @@ class AgeComparisonDb:
     def __init__(self, **ages):
         self.ages = ages
 
+    def queries(self) -> list[str]:
+        return ['list_people()'] + [f'is_older({a}, {b})' for a in self.ages for b in self.ages]
+
     def query(self, q: str) -> str:
         m = re_list_people.match(q)
         if m:
@@ -90,6 +98,9 @@ class LegsComparisonDb:
     def __init__(self, **legs):
         self.legs = legs
 
+    def queries(self) -> list[str]:
+        return ['list_animals()'] + [f'has_more_legs({a}, {b})' for a in self.legs for b in self.legs]
+
     def query(self, q: str) -> str:
         m = re_list_animals.match(q)
         if m:
@@ -136,7 +147,7 @@ class Session:
             raise Exception("max_interactions must be at least 1 in Session")
 
         print(f'============\n{self.prompt}\n=============\n')
-        completion = openai.Completion.create(model=model, prompt=self.prompt, temperature=0, max_tokens=max_tokens, stop=["Database","SESSION"])
+        completion = completions.create(model=model, prompt=self.prompt, temperature=0, max_tokens=max_tokens, stop=["Database","SESSION"])
         gpt_text = completion.choices[0].text
         print(f'{gpt_text}\n=================\n\n\n')
 
@@ -173,6 +184,7 @@ class Session:
             return results
 
 def multi_session(theme: str, question: str, dbs: list, answers: list[str], max_interactions: int):
+    os.makedirs('auto_transcripts', exist_ok=True)
     now = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
     filename = f'auto_transcripts/{theme}--{now}.html'
     sessions = [Session.create(question=question, dbs=dbs, answers=answers, max_interactions=max_interactions)]
@@ -187,7 +199,7 @@ def multi_session(theme: str, question: str, dbs: list, answers: list[str], max_
                 else:
                     next_sessions.append(session)
         finally:
-            with open(filename, 'w') as f:
+            with open(filename, 'w') as f, metrics.span('write'):
                 f.write(html_header)
                 f.write(''.join(session.get_html() for session in next_sessions))
                 f.write('</body>\n</html>\n')
@@ -197,46 +209,157 @@ def multi_session(theme: str, question: str, dbs: list, answers: list[str], max_
     print('Done')
 
 def main():
-    theme = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('theme', type=str, help='Which set of candidate databases and question to run')
+    # multi_session makes its requests one at a time, so there's no --concurrency
+    planning.add_arguments(parser, concurrency=False)
+    args = parser.parse_args()
+
+    if args.plan:
+        plan_theme(args.theme, args.latency, args.rate_limit)
+    else:
+        metrics.configure()
+        completions.configure()
+        run_theme(args.theme)
+
+def run_theme(theme: str):
+    kwargs = get_theme(theme)
+    if kwargs == None:
+        print(f"Unrecognized theme {theme}")
+    else:
+        multi_session(theme=theme, **kwargs)
+
+def plan_theme(theme: str, latency: float, rate_limit: float):
+    """
+    Print an upper bound on the number of completion requests a theme makes, and estimates of
+    their tokens and wall time.
+
+    Sibling sessions split their parent's candidate databases between them, so no level of the
+    tree has more live sessions than there are databases. A level also can't have more than
+    branching^depth sessions, where branching is the most distinct responses that any valid
+    command gets from the candidate databases.
+    """
+    kwargs = get_theme(theme)
+    if kwargs == None:
+        print(f"Unrecognized theme {theme}")
+        return
+    dbs = kwargs['dbs']
+    branching = max(len(set(db.query(q) for db in dbs)) for q in set(q for db in dbs for q in db.queries()))
+    base_tokens = planning.count_tokens(initial_prompt + f"Database: {kwargs['question']}\nUser:")
+    # Each interaction adds a completion and a short database response
+    step_tokens = max_tokens + planning.count_tokens('Database: alice, bob\nUser:')
+
+    requests = 0
+    prompt_tokens = 0
+    print(f'Candidate databases {len(dbs)}, at most {branching} distinct response(s) per command')
+    for depth in range(kwargs['max_interactions']):
+        sessions = min(len(dbs), branching ** depth)
+        print(f'Level {depth + 1}: at most {sessions} session(s)')
+        requests += sessions
+        prompt_tokens += sessions * (base_tokens + depth * step_tokens)
+    # Sessions are asked one after another, and each level waits for the one before
+    planning.print_plan(requests, prompt_tokens, requests * max_tokens, latency, 1, rate_limit)
+
+def weak_orderings(names: list[str]) -> Iterator[dict[str,int]]:
+    """Every ranking of the names with ties allowed, as name -> rank where 0 is the lowest"""
+    if len(names) == 0:
+        yield {}
+        return
+    # Choose the non-empty set of names that share the lowest rank, then rank the rest above them
+    for size in range(1, len(names) + 1):
+        for lowest in itertools.combinations(names, size):
+            rest = [name for name in names if name not in lowest]
+            for ranks in weak_orderings(rest):
+                result = {name: 0 for name in lowest}
+                result.update({name: rank + 1 for name, rank in ranks.items()})
+                yield result
+
+class WorldSpec:
+    """
+    A compact description of the candidate worlds for a theme: who or what exists, which values
+    they can have, and whether the answer is the one with the highest or the lowest value.
+
+    If only the order of the values matters to the question (order_only), worlds that rank
+    everybody the same way are equivalent. Rather than enumerating every assignment of values and
+    then collapsing them, this enumerates the distinct rankings (with ties) directly and gives
+    each rank a fixed value. Otherwise every assignment of values is a separate world.
+    """
+    def __init__(self, db_class, names: list[str], values: list[int], pick: str, order_only: bool = True):
+        if pick not in ('highest', 'lowest'):
+            raise Exception(f"pick must be highest or lowest, not {pick}")
+        if order_only and len(values) < len(names):
+            raise Exception("Need at least as many values as names to represent every ranking")
+        self.db_class = db_class
+        self.names = names
+        self.values = sorted(values)
+        self.pick = pick
+        self.order_only = order_only
+
+    def assignments(self) -> Iterator[dict[str,int]]:
+        if self.order_only:
+            for ranks in weak_orderings(self.names):
+                yield {name: self.values[ranks[name]] for name in self.names}
+        else:
+            for values in itertools.product(self.values, repeat=len(self.names)):
+                yield dict(zip(self.names, values))
+
+    def expected_answer(self, assignment: dict[str,int]) -> str:
+        target = max(assignment.values()) if self.pick == 'highest' else min(assignment.values())
+        winners = [name for name, value in assignment.items() if value == target]
+        return winners[0] if len(winners) == 1 else 'unknown'
+
+    def worlds(self) -> tuple[list, list[str]]:
+        """The candidate databases and the expected answer for each"""
+        assignments = list(self.assignments())
+        return [self.db_class(**a) for a in assignments], [self.expected_answer(a) for a in assignments]
+
+def theme_from_spec(question: str, spec: WorldSpec, max_interactions: int) -> dict:
+    dbs, answers = spec.worlds()
+    return dict(question=question, dbs=dbs, answers=answers, max_interactions=max_interactions)
+
+def get_theme(theme: str) -> Optional[dict]:
+    """The question, candidate databases, expected answers and depth limit for a theme"""
+    ages = [37, 46, 55, 63, 91]
+    legs = [2, 4, 6, 8]
     if theme == 'age_values_two_people':
-        multi_session(
-            theme = theme,
+        return theme_from_spec(
             question = "Who is the youngest? Available commands: list_people(), age(Person), the_answer_is(Person_or_Unknown).",
-            dbs = [
-                AgeDb(alice = 63, bob = 46),
-                AgeDb(alice = 37, bob = 91),
-                AgeDb(alice = 55, bob = 55),
-            ],
-            answers = ['bob', 'alice', 'unknown'],
+            spec = WorldSpec(AgeDb, ['alice', 'bob'], ages, pick = 'lowest'),
             max_interactions = 5
         )
+    elif theme == 'age_values_three_people':
+        return theme_from_spec(
+            question = "Who is the youngest? Available commands: list_people(), age(Person), the_answer_is(Person_or_Unknown).",
+            spec = WorldSpec(AgeDb, ['alice', 'bob', 'carol'], ages, pick = 'lowest'),
+            max_interactions = 6
+        )
     elif theme == 'age_comparison_two_people':
-        multi_session(
-            theme = theme,
+        # Two people of the same age are included: neither is older, so the answer is unknown
+        return theme_from_spec(
             question = "Who is the oldest? Available commands: list_people(), is_older(Person, Person), the_answer_is(Person_or_Unknown).",
-            dbs = [
-                AgeComparisonDb(alice = 63, bob = 46),
-                AgeComparisonDb(alice = 37, bob = 91),
-                #AgeComparisonDb(alice = 55, bob = 55),     # not sure if two people being the exact same age is a valid test case
-            ],
-            answers = ['alice', 'bob', 'unknown'],
+            spec = WorldSpec(AgeComparisonDb, ['alice', 'bob'], ages, pick = 'highest'),
             max_interactions = 5
         )
+    elif theme == 'age_comparison_three_people':
+        return theme_from_spec(
+            question = "Who is the oldest? Available commands: list_people(), is_older(Person, Person), the_answer_is(Person_or_Unknown).",
+            spec = WorldSpec(AgeComparisonDb, ['alice', 'bob', 'carol'], ages, pick = 'highest'),
+            max_interactions = 7
+        )
     elif theme == 'legs_comparison':
-        multi_session(
-            theme = theme,
+        return theme_from_spec(
             question = "Which animal has the most legs? Available commands: list_animals(), has_more_legs(Animal, Animal), the_answer_is(Animal_or_Unknown).",
-            dbs = [
-                LegsComparisonDb(pratchett = 4, scuttle = 8),
-                LegsComparisonDb(pratchett = 4, scuttle = 2),
-                LegsComparisonDb(pratchett = 8, scuttle = 8),
-            ],
-            answers = ['scuttle', 'pratchett', 'unknown'],
+            spec = WorldSpec(LegsComparisonDb, ['pratchett', 'scuttle'], legs, pick = 'highest'),
             max_interactions = 5
         )
+    elif theme == 'legs_comparison_three_animals':
+        return theme_from_spec(
+            question = "Which animal has the most legs? Available commands: list_animals(), has_more_legs(Animal, Animal), the_answer_is(Animal_or_Unknown).",
+            spec = WorldSpec(LegsComparisonDb, ['pratchett', 'scuttle', 'hob'], legs, pick = 'highest'),
+            max_interactions = 7
+        )
     else:
-        print(f"Unrecognized theme {theme}")
+        return None
 
 if __name__ == '__main__':
     main()
-
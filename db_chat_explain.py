@@ -2,11 +2,14 @@ from datetime import datetime
 import html
 import os
 import readline
-import openai
+
+import completions
+import metrics
 
 os.makedirs('transcripts', exist_ok=True)
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+metrics.configure()
+completions.configure()
 max_tokens = 60
 model = 'text-davinci-003'
 
@@ -50,7 +53,7 @@ try:
         db_text = input("Database: ")
         prompt += f"Database: {db_text}\nUser:"
         html_text += html.escape(f"Database: {db_text}\nUser:")
-        completion = openai.Completion.create(model=model, prompt=prompt, temperature=0, max_tokens=max_tokens, stop=["Database","SESSION"])
+        completion = completions.create(model=model, prompt=prompt, temperature=0, max_tokens=max_tokens, stop=["Database","SESSION"])
         gpt_text = completion.choices[0].text
         print(f"User:{gpt_text}")
         prompt += gpt_text
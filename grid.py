@@ -1,132 +1,412 @@
 import argparse
+import collections
+import concurrent.futures
 import json
 import jsonschema
 import os
-import openai
 import random
 import shutil
+import threading
 from typing import Optional
 
+import completions
 import grid_questions
 import grid_grading
+import metrics
+import planning
 
-def get_key(data, q):
-    prompt_template = data['prompt_templates'][q['prompt_template']]
-    m = data['maps'][q['map']]
-    model = q['params']['model']
-    temperature = q['params']['temperature']
-    max_tokens = q['params']['max_tokens']
-    question = q['question']
-    return prompt_template, m, model, temperature, max_tokens, question
+# When asking, save the data file after this many new responses, or this many seconds
+save_every = 100
+save_seconds = 10.0
 
-def main():
-    # Command line argument parsing
+# The fields of a question that hold the AI's answers, carried over when regenerating
+answer_fields = ['response', 'responses']
+
+# absolute filename -> (modification time, size, parsed and validated data), so a long-lived process
+# (see daemon.py) doesn't re-read a data file that hasn't changed. Only the most recently used
+# few are kept.
+_data_cache = collections.OrderedDict()
+_data_cache_size = 4
+
+def load_data(filename: str, schema) -> dict:
+    """Read and validate a data file. The result is shared between callers, so don't modify it."""
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    cached = _data_cache.get(path)
+    if cached != None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        _data_cache.move_to_end(path)
+        return cached[2]
+    with open(path) as f:
+        with metrics.span('read'):
+            data = json.load(f)
+        with metrics.span('validate'):
+            jsonschema.validate(instance=data, schema=schema)
+    _data_cache[path] = (st.st_mtime_ns, st.st_size, data)
+    _data_cache.move_to_end(path)
+    while len(_data_cache) > _data_cache_size:
+        _data_cache.popitem(last=False)
+    return data
 
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument('--key', type=str, help='OpenAI API key (defaults to env var OPENAI_API_KEY)')
-    parser.add_argument('--model', type=str, default='text-davinci-003', help='OpenAI model name (default text-davinci-003)')
+    parser.add_argument('--model', type=str, nargs='+', default=['text-davinci-003'], help='OpenAI model name(s) (default text-davinci-003). With several models, each question gets a run per model, and they are asked concurrently.')
+    parser.add_argument('--backend', type=str, choices=['openai', 'local'], help='Where completions come from: openai, or local to run a transformers model on the CPU (default env var AITEST_BACKEND, otherwise openai)')
+    parser.add_argument('--local-model', type=str, help='Model name or path for the local backend (default env var AITEST_LOCAL_MODEL, otherwise gpt2)')
     parser.add_argument('--max-tokens', type=int, default=80, help='The maximum number of tokens to output at a time')
+    parser.add_argument('--samples', type=int, default=1, help='Number of completions to request per question, using the n parameter of a single call (default 1)')
+    parser.add_argument('--temperature', type=float, default=0, help='Sampling temperature (default 0). Multiple samples are only useful above 0.')
     parser.add_argument('--generate', action='store_true', help='Regenerate questions')
-    parser.add_argument('--ask', action='store_true', help='Actually ask the questions. This will call the OpenAI completion API. It will store one answer at a time, so it should be safe to interrupt (?)')
+    parser.add_argument('--ask', action='store_true', help='Actually ask the questions. This will call the OpenAI completion API. Answers are saved every 100 responses or 10 seconds, and when asking stops, so it should be safe to interrupt (?)')
+    parser.add_argument('--tolerance', type=float, help="When asking, stop asking about a category (answer type, map and prompt template) once its accuracy confidence interval is narrower than this. By default every question is asked.")
     parser.add_argument('--grade', action='store_true', help="Grade AI's answers")
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes to use when grading (default 1)')
+    parser.add_argument('--results', type=str, help='When grading, also add the results to this columnar results store (see grid_results.py)')
     parser.add_argument('--filename', type=str, default='data.json', help='Data filename (default data.json), .old is appended for backup copy')
+    parser.add_argument('--trace', type=str, help='Append a JSONL trace of timed spans (request, validate, write, backup, grade) to this file (default env var AITEST_TRACE)')
+    parser.add_argument('--metrics', type=str, help='Write a Prometheus text snapshot of latencies and token counts to this file at exit (default env var AITEST_METRICS)')
+    planning.add_arguments(parser)
     parser.add_argument('-v', action='count', default=0, help='Make more verbose')
-    args = parser.parse_args()
+    return parser
 
-    filename = args.filename
+def main():
+    # Command line argument parsing
+    args = make_parser().parse_args()
+    metrics.configure(trace=args.trace, prometheus=args.metrics)
 
     with open('grid_schema.json') as f:
         schema = json.load(f)
 
-    model = args.model
+    run(args, schema)
+
+def run(args, schema):
+    filename = args.filename
     max_tokens = args.max_tokens
-    temperature = 0
-    params = {'model':model, 'max_tokens':max_tokens, 'temperature':temperature}
+    temperature = args.temperature
+    samples = args.samples
+    params_list = []
+    for model in args.model:
+        params = {'model':model, 'max_tokens':max_tokens, 'temperature':temperature, 'n':samples}
+        # A model given twice would get two runs with the same hash
+        if all(grid_questions.params_key(params) != grid_questions.params_key(p) for p in params_list):
+            params_list.append(params)
 
     if args.generate:
-        # See if the file exists and contains valid results
-        old_responses = {}
+        # See if the file exists and contains valid results. Only keep an index from
+        # run hash to answers, not the old data itself.
+        old_answers = {}
         if os.path.exists(filename):
-            with open(filename) as f:
-                old_data = json.load(f)
             try:
-                jsonschema.validate(instance=old_data, schema=schema)
-                for q in old_data['questions']:
-                    if 'response' in q:
-                        key = get_key(old_data, q)
-                        if key in old_responses:
-                            raise Exception(f"Unexpected duplicate key {key}")
-                        old_responses[key] = q['response']
-            except:
-                pass
-
-        quiz = grid_questions.get_quiz(params)
-        for q in quiz['questions']:
-            key = get_key(quiz, q)
-            if key in old_responses:
-                q['response'] = old_responses[key]
-                del old_responses[key]
-
-        if len(old_responses) > 0:
-            raise Exception("Some old responses would be deleted. If that is the intention, delete them manually, or delete the entire {filename}.")
+                old_data = load_data(filename, schema)
+            except (json.JSONDecodeError, jsonschema.ValidationError):
+                # Not a valid data file, so there are no answers to keep
+                old_data = {'prompt_templates': [], 'maps': [], 'questions': []}
+            # Anything wrong from here on must stop before the file is overwritten
+            for q, r, h in grid_questions.run_hashes(old_data):
+                if h in old_answers:
+                    raise Exception(f"Unexpected duplicate question hash {h}")
+                old_answers[h] = {field: r[field] for field in answer_fields if field in r}
+            _data_cache.pop(os.path.abspath(filename), None)
+            old_data = None
+
+        quiz = grid_questions.get_quiz(params_list)
+        added = 0
+        kept = 0
+        for q, r, h in grid_questions.run_hashes(quiz):
+            answers = old_answers.pop(h, None)
+            if answers == None:
+                added += 1
+            else:
+                kept += 1
+                r.update(answers)
+
+        if any(len(answers) > 0 for answers in old_answers.values()):
+            raise Exception(f"Some old responses would be deleted. If that is the intention, delete them manually, or delete the entire {filename}.")
+        print(f"Runs (questions x params): {added} added, {len(old_answers)} removed, {kept} kept")
 
         with open(filename, 'w') as f:
-            jsonschema.validate(instance=quiz, schema=schema)
-            json.dump(quiz, f, indent=4)
+            with metrics.span('validate'):
+                jsonschema.validate(instance=quiz, schema=schema)
+            with metrics.span('write'):
+                json.dump(quiz, f, indent=4)
 
-    if args.ask:
-        ask_questions(filename, f'{filename}.old', model, max_tokens, temperature, schema)
+    if args.plan:
+        if os.path.exists(filename):
+            data = load_data(filename, schema)
+        else:
+            data = grid_questions.get_quiz(params_list)
+        plan_questions(data, params_list, args)
+    elif args.ask:
+        completions.configure(args.backend, args.local_model)
+        ask_questions(filename, f'{filename}.old', params_list, schema, args.tolerance, args.concurrency)
 
     if args.grade:
-        with open(filename) as f:
-            data = json.load(f)
-            jsonschema.validate(instance=data, schema=schema)
-            grid_grading.grade(data, args.v)
+        data = load_data(filename, schema)
+        with metrics.span('grade', questions=len(data['questions'])):
+            codes = grid_grading.grade(data, args.v, args.jobs)
+        if args.results:
+            import grid_results
+            store = grid_results.ResultsStore.load(args.results)
+            store = store.replace_run(grid_results.ResultsStore.from_data(data, codes, run=os.path.abspath(filename)))
+            store.save(args.results)
 
     print("Done")
     
-def ask_questions(filename: str, old_filename: str, model:str, max_tokens:int, temperature:float, schema):
+def find_run(q, key:str) -> Optional[dict]:
+    for run in grid_questions.runs(q):
+        if grid_questions.params_key(run['params']) == key:
+            return run
+    return None
+
+def runs_by_key(data, keys:list[str]) -> dict[str, list[dict]]:
+    """The run for each params key, by question index. Every question must have a run for every key."""
+    runs = {key: [find_run(q, key) for q in data['questions']] for key in keys}
+    for key in keys:
+        if None in runs[key]:
+            raise Exception(f"Wrong params in question (no run for {key}, regenerate with these models)")
+    return runs
+
+def ask_questions(filename: str, old_filename: str, params_list:list[dict], schema, tolerance:Optional[float]=None, concurrency:int=1):
+    """
+    Ask every question that doesn't have a response yet, for each set of params. Each set of
+    params gets its own concurrency worker threads. The data file is rewritten every
+    save_every responses or save_seconds, and when asking stops for any reason, so it should be
+    safe to interrupt.
+    """
     # Set up OpenAI session
     print(f"Using filename: {filename} ({old_filename})")
-    print(f"Using model: {model}")
+    for params in params_list:
+        print(f"Using model: {params['model']}")
+        if params['n'] > 1:
+            print(f"Using {params['n']} samples per question at temperature {params['temperature']}")
+    if tolerance != None:
+        print(f"Using tolerance: {tolerance}")
+    if concurrency > 1:
+        print(f"Using concurrency: {concurrency} per model")
 
-    # For each question...
-    while True:
-        # Read in the original datafile and create backup copy if it's valid
-        with open(filename) as f:
+    # Read in the original datafile
+    with open(filename) as f:
+        with metrics.span('read'):
             data = json.load(f)
+        with metrics.span('validate'):
             jsonschema.validate(instance=data, schema=schema)
-        shutil.copyfile(filename, old_filename)
-
-        # Try to find a random question that doesn't have a response yet
-        found_q = False
-        indices = list(range(len(data['questions'])))
-        random.shuffle(indices)
-        for index in indices:
-            q = data['questions'][index]
-            if q['params']['model'] != model or q['params']['max_tokens'] != max_tokens or q['params']['temperature'] != temperature:
-                raise Exception(f"Wrong params in question")
-            if 'response' not in q:
-                print(f"QUESTION: {q['question']}")
+
+    keys = [grid_questions.params_key(params) for params in params_list]
+    runs = runs_by_key(data, keys)
+
+    if tolerance == None:
+        pickers = {key: RandomPicker(data, runs[key]) for key in keys}
+    else:
+        pickers = {key: AdaptivePicker(data, runs[key], tolerance) for key in keys}
+
+    # Workers only read data. Their responses wait in answered until the main thread writes
+    # them into the runs and saves, so the file isn't rewritten (while holding up the other
+    # workers) on every response.
+    lock = threading.Lock()
+    stop = threading.Event()
+    wake = threading.Event()
+    answered = []
+
+    def save():
+        # Create backup copy of the last valid file, then write the data file
+        with metrics.span('backup'):
+            shutil.copyfile(filename, old_filename)
+        with open(filename, 'w') as f:
+            with metrics.span('validate'):
+                jsonschema.validate(instance=data, schema=schema)
+            with metrics.span('write'):
+                json.dump(data, f, indent=4)
+
+    def flush():
+        nonlocal answered
+        with lock:
+            batch = answered
+            answered = []
+        if len(batch) > 0:
+            for run, fields in batch:
+                run.update(fields)
+            save()
+
+    def worker(params):
+        key = grid_questions.params_key(params)
+        picker = pickers[key]
+        while not stop.is_set():
+            # Pick a question that doesn't have a response yet, and that no other worker is asking
+            with lock:
+                index = picker.pick()
+            if index == None:
+                return
+            fields = None
+            try:
+                q = data['questions'][index]
+                if len(params_list) > 1:
+                    print(f"QUESTION ({params['model']}): {q['question']}")
+                else:
+                    print(f"QUESTION: {q['question']}")
                 prompt_template = data['prompt_templates'][q['prompt_template']]
                 m = data['maps'][q['map']]
                 prompt = prompt_template.replace('{map}', m).replace('{question}', q['question'])
-                completion = openai.Completion.create(model=model, prompt=prompt, temperature=temperature, max_tokens=max_tokens)
-                q['response'] = completion.choices[0].text
-                found_q = True
+                completion = completions.create(model=params['model'], prompt=prompt, temperature=params['temperature'], max_tokens=params['max_tokens'], n=params['n'])
+                choices = sorted(completion.choices, key=lambda choice: choice.index)
+                fields = {'response': choices[0].text}
+                if params['n'] > 1:
+                    fields['responses'] = [choice.text for choice in choices]
+            finally:
+                with lock:
+                    picker.done(index, params, fields)
+                    if fields != None:
+                        answered.append((runs[key][index], fields))
+                        if len(answered) >= save_every:
+                            wake.set()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(params_list) * concurrency) as executor:
+            futures = [executor.submit(worker, params) for params in params_list for _ in range(concurrency)]
+            for future in futures:
+                future.add_done_callback(lambda future: wake.set())
+            try:
+                # Save as responses come in, and stop everything as soon as one worker fails
+                while not all(future.done() for future in futures):
+                    wake.wait(save_seconds)
+                    wake.clear()
+                    flush()
+                    if any(future.done() and future.exception() != None for future in futures):
+                        stop.set()
+                for future in futures:
+                    future.result()
+            except BaseException:
+                stop.set()
+                raise
+    finally:
+        # Including the responses to requests that were in flight when something went wrong
+        flush()
+
+    # There are no questions remaining
+    print("No unanswered questions remaining")
+
+def plan_questions(data, params_list:list[dict], args):
+    """Print the number of requests --ask would make, and estimates of their tokens and wall time"""
+    # Count the shared template and map once per combination, then just the question
+    base_tokens = {}
+    requests = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+    runs = runs_by_key(data, [grid_questions.params_key(params) for params in params_list])
+    for params in params_list:
+        key = grid_questions.params_key(params)
+        pending = [q for q, run in zip(data['questions'], runs[key]) if 'response' not in run]
+        for q in pending:
+            combination = q['prompt_template'], q['map']
+            if combination not in base_tokens:
+                prompt = data['prompt_templates'][q['prompt_template']].replace('{map}', data['maps'][q['map']]).replace('{question}', '')
+                base_tokens[combination] = planning.count_tokens(prompt)
+            prompt_tokens += base_tokens[combination] + planning.count_tokens(q['question'])
+        print(f"Pending questions for {params['model']}: {len(pending)} of {len(data['questions'])}")
+        requests += len(pending)
+        completion_tokens += len(pending) * params['max_tokens'] * params['n']
+    if args.tolerance != None:
+        print("With --tolerance, this is an upper bound")
+    # Each model has its own concurrency (and rate limit), so they add up
+    planning.print_plan(requests, prompt_tokens, completion_tokens, args.latency, args.concurrency * len(params_list), args.rate_limit * len(params_list))
+
+class RandomPicker:
+    """Picks unanswered questions at random, given the run for one params key of each question"""
+    def __init__(self, data, runs:list[dict]):
+        self.pending = [index for index, run in enumerate(runs) if 'response' not in run]
+
+    def pick(self) -> Optional[int]:
+        """Take an unanswered question out of the pending list, or None if there are none left"""
+        return take_random(self.pending)
 
-                # Write the data file
-                with open(filename, 'w') as f:
-                    jsonschema.validate(instance=data, schema=schema)
-                    json.dump(data, f, indent=4)
-                break
+    def done(self, index:int, params:dict, fields:Optional[dict]):
+        """Put a picked question back if there wasn't a response"""
+        if fields == None:
+            self.pending.append(index)
 
-        # Exit the loop if there are no questions remaining
-        if not found_q:
-            print("No unanswered questions remaining")
-            break
+def take_random(items:list) -> Optional[int]:
+    """Remove and return a random item, without shifting the rest of the list"""
+    if len(items) == 0:
+        return None
+    i = random.randrange(len(items))
+    items[i], items[-1] = items[-1], items[i]
+    return items.pop()
+
+class AdaptivePicker:
+    """
+    Picks unanswered questions from the category that most needs them, looking only at the runs
+    for one params key.
+
+    Questions are grouped by (answer type, map, prompt template). A category stops being asked
+    about once the confidence interval on its accuracy is narrower than tolerance. Of the rest,
+    the category with the highest importance plus interval width goes first. Open questions
+    can't be graded, so their categories never converge.
+
+    The per-category counts are built once and then kept up to date with done(), so a pick
+    doesn't re-grade the whole file.
+    """
+    def __init__(self, data, runs:list[dict], tolerance:float):
+        self.data = data
+        self.tolerance = tolerance
+        self.stats = collections.defaultdict(lambda: [0, 0])
+        self.pending = collections.defaultdict(list)
+        self.importance = collections.defaultdict(float)
+        for index, (q, run) in enumerate(zip(data['questions'], runs)):
+            record = grid_grading.make_record(q, run)
+            outcome, _ = grid_grading.grade_record(record)
+            if outcome == 'unanswered':
+                category = self.category(q)
+                self.pending[category].append(index)
+                self.importance[category] = max(self.importance[category], q['annotations'].get('importance', 0.0))
+            else:
+                self.add(record, outcome)
+
+    def category(self, q) -> tuple:
+        return q['annotations']['answer_type'], q['map'], q['prompt_template']
+
+    def add(self, record, outcome:str):
+        if outcome in ('correct', 'incorrect', 'unparsed'):
+            category = record.answer_type, record.map, record.prompt_template
+            self.stats[category][0] += outcome == 'correct'
+            self.stats[category][1] += 1
+
+    def pick(self) -> Optional[int]:
+        """Take an unanswered question out of the pending lists, or None if no category needs one"""
+        best = None
+        best_priority = None
+        for category, pending in self.pending.items():
+            if len(pending) == 0:
+                continue
+            correct, n = self.stats[category]
+            if n > 0:
+                low, high = grid_grading.wilson_interval(correct, n)
+                width = high - low
+            elif category[0] == 'open':
+                width = 0.0
+            else:
+                width = 1.0
+            if width < self.tolerance and category[0] != 'open':
+                continue
+            priority = self.importance[category] + width
+            if best == None or priority > best_priority:
+                best = category
+                best_priority = priority
+
+        if best == None:
+            return None
+        return take_random(self.pending[best])
+
+    def done(self, index:int, params:dict, fields:Optional[dict]):
+        """Count the response to a picked question, or put it back if there wasn't one"""
+        q = self.data['questions'][index]
+        if fields == None:
+            self.pending[self.category(q)].append(index)
+        else:
+            record = grid_grading.make_record(q, dict(fields, params=params))
+            self.add(record, grid_grading.grade_record(record)[0])
 
 def junk():
+    import openai
+
     # Set up Grid World
 
     questions = [
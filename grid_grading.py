@@ -1,126 +1,376 @@
+import array
+import collections
+import json
+import math
+import multiprocessing
+import numpy as np
 import re
-from typing import Optional
+from typing import Iterator, NamedTuple, Optional
 
-re_undefined = re.compile(r"^ In the context of Grid World, I don't have any information.*$")
-re_yes = re.compile(r"^ Yes\b")
-re_no = re.compile(r"^ No\b")
-re_int = re.compile(r"^ ([0-9]+)$")
-re_wall = re.compile(r"\b[Ww]all\b")
-re_floor = re.compile(r"\b[Ff]loor\b")
-re_agent = re.compile(r"\b[Aa]gent\b")
-re_goal = re.compile(r"\b[Gg]oal\b")
+import grid_questions
+
+# One combined pattern per answer type, so each response is scanned once
+_undefined = r"In the context of Grid World, I don't have any information.*"
+re_bool = re.compile(rf"^ (?:(?P<undefined>{_undefined}$)|(?P<yes>Yes\b)|(?P<no>No\b))")
+re_int = re.compile(rf"^ (?:(?P<undefined>{_undefined})|(?P<int>[0-9]+))$")
+re_tile = re.compile(rf"^ (?P<undefined>{_undefined})$|\b(?:(?P<wall>[Ww]all)|(?P<floor>[Ff]loor)|(?P<agent>[Aa]gent)|(?P<goal>[Gg]oal))\b")
+tile_symbols = {'wall': '#', 'floor': '.', 'agent': '@', 'goal': '$'}
 
 re_q_tile = re.compile(r"What is located at tile \(([0-9]+),([0-9]+)\)\?")
 
 class Map:
+    """A grid of single-character tiles. Tiles that haven't been filled in are blank."""
     def __init__(self, w, h):
-        self.cells = [[None] * w for _ in range(h)]
+        self.cells = np.full((h, w), ' ', dtype='<U1')
         self.w = w
         self.h = h
 
+    @classmethod
+    def from_string(cls, s: str):
+        rows = s.split('\n')
+        result = cls(max(len(row) for row in rows), len(rows))
+        for y, row in enumerate(rows):
+            result.cells[y, :len(row)] = list(row)
+        return result
+
+    def set_many(self, xs, ys, answers):
+        """Fill in tiles from 0-based coordinates and parsed answers (None becomes ?, otherwise the first character)"""
+        xs = np.asarray(xs, dtype=np.intp)
+        ys = np.asarray(ys, dtype=np.intp)
+        symbols = np.array(['?' if answer == None else answer[0] for answer in answers], dtype='<U1')
+        inside = (xs >= 0) & (xs < self.w) & (ys >= 0) & (ys < self.h)
+        self.cells[ys[inside], xs[inside]] = symbols[inside]
+
     def set(self, question, answer):
-        m = re_q_tile.match(question)
-        if m:
-            x = int(m.group(1)) - 1
-            y = int(m.group(2)) - 1
-            if x >= 0 and x < self.w and y >= 0 and y < self.h:
-                if answer == None:
-                    self.cells[y][x] = '?'
-                else:
-                    self.cells[y][x] = answer[0]
+        tile = question_tile(question)
+        if tile:
+            self.set_many([tile[0] - 1], [tile[1] - 1], [answer])
+
+    def answered(self) -> np.ndarray:
+        return self.cells != ' '
+
+    def errors(self, truth) -> np.ndarray:
+        """Tiles that were answered but disagree with the ground truth map"""
+        return self.answered() & (self.cells != truth.cells)
 
     def __str__(self):
         return ''.join(''.join(answers) +'\n' for answers in self.cells)
 
-def grade(data, verbosity:int):
-    correct = []
-    incorrect = []
-    unparsed = []
-    unanswered = []
-    open_questions = []
+def question_tile(question: str) -> Optional[tuple[int,int]]:
+    m = re_q_tile.match(question)
+    if m:
+        return int(m.group(1)), int(m.group(2))
+    else:
+        return None
+
+class TileErrors:
+    """Per-tile error counts, accumulated over every reconstructed map of the same size"""
+    def __init__(self):
+        self.errors = {}
+        self.totals = {}
+
+    def add(self, answers: Map, truth: Map):
+        shape = truth.cells.shape
+        if shape not in self.totals:
+            self.errors[shape] = np.zeros(shape, dtype=np.int64)
+            self.totals[shape] = np.zeros(shape, dtype=np.int64)
+        self.errors[shape] += answers.errors(truth)
+        self.totals[shape] += answers.answered()
+
+    def rates(self, shape) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.errors[shape] / self.totals[shape]
+
+    def __str__(self):
+        # Error rate per tile in tenths (0-9, * for always wrong), blank for tiles that were never asked about
+        result = ''
+        for shape in self.totals:
+            rates = self.rates(shape)
+            tenths = np.minimum(np.nan_to_num(rates) * 10, 9).astype(int).astype(str)
+            tenths[rates == 1] = '*'
+            tenths[np.isnan(rates)] = ' '
+            result += f'{shape[1]}x{shape[0]}, {self.totals[shape].max()} answer(s) per tile:\n'
+            result += ''.join(''.join(row) + '\n' for row in tenths)
+        return result
+
+class MapReconstruction:
+    """
+    Rebuilds every map, separately for each params key, from the lookup answers. A later answer
+    for the same tile replaces an earlier one. Only the grids are kept, not the answers.
+    """
+    def __init__(self, maps: list[str]):
+        self.maps = maps
+        self.grids = {}
+
+    def grid(self, m: int, key: str) -> Map:
+        if (m, key) not in self.grids:
+            rows = self.maps[m].split('\n')
+            self.grids[m, key] = Map(max(len(row) for row in rows), len(rows))
+        return self.grids[m, key]
+
+    def add(self, m: int, key: str, tile: Optional[tuple[int,int]], answer: Optional[str]):
+        if tile:
+            grid = self.grid(m, key)
+            x, y = tile[0] - 1, tile[1] - 1
+            if 0 <= x < grid.w and 0 <= y < grid.h:
+                grid.cells[y, x] = '?' if answer == None else answer[0]
+
+    def merge(self, other):
+        """Add the grids from a reconstruction of later questions"""
+        for (m, key), answers in other.grids.items():
+            grid = self.grid(m, key)
+            answered = answers.answered()
+            grid.cells[answered] = answers.cells[answered]
+
+    def results(self) -> list[tuple[int, str, Map, Map]]:
+        """(map index, params key, ground truth, map according to the answers) for every map that had lookup questions"""
+        return [(m, key, Map.from_string(self.maps[m]), self.grids[m, key]) for m, key in sorted(self.grids)]
+
+outcomes = ['correct', 'incorrect', 'unparsed', 'open', 'unanswered']
 
-    map0 = Map(9,6)
+class Record(NamedTuple):
+    """The small per-run tuple that grading needs"""
+    map: int
+    prompt_template: int
+    question: str
+    response: Optional[str]
+    answer_type: str
+    expected_answer: Optional[str]
+    tile: Optional[list[int]]
+    responses: tuple[str, ...]
+    params_key: str
 
+def make_record(q: dict, run: dict) -> Record:
+    annotations = q['annotations']
+    return Record(q['map'], q['prompt_template'], q['question'], run.get('response', None),
+                  annotations['answer_type'], annotations.get('expected_answer', None), annotations.get('tile', None),
+                  tuple(run.get('responses', ())), grid_questions.params_key(run['params']))
+
+def iter_records(data) -> Iterator[Record]:
+    """Yield a record for every run of every question, one at a time"""
     for q in data['questions']:
-        question = q['question']
-        response = q.get('response', None)
-        typ = q['annotations']['answer_type']
-        if response == None:
-            unanswered.append(question)
-        elif 'expected_answer' not in q['annotations']:
-            open_questions.append((q['prompt_template'], q['map'], question, response))
-        else:
-            if typ == 'bool':
-                answer = convert_bool(response)
-            elif typ == 'int':
-                answer = convert_int(response)
-            elif typ == 'tile':
-                answer = convert_tile(response)
-            else:
-                answer = None
+        for run in grid_questions.runs(q):
+            yield make_record(q, run)
+
+def grade_record(record: Record) -> tuple[str, Optional[str]]:
+    """Return (outcome, parsed answer) where outcome is one of correct, incorrect, unparsed, open, unanswered"""
+    if record.response == None:
+        return 'unanswered', None
+    if record.expected_answer == None:
+        return 'open', None
+    answer = convert(record.answer_type, record.response)
+    if answer == None:
+        return 'unparsed', None
+    elif answer == record.expected_answer:
+        return 'correct', answer
+    else:
+        return 'incorrect', answer
+
+def grade_samples(record: Record) -> Optional[tuple[bool, float]]:
+    """
+    For a gradeable question with more than one sampled response, return whether the majority
+    vote is correct and the fraction of samples that agree with it. Otherwise None.
+    """
+    if record.expected_answer == None or len(record.responses) < 2:
+        return None
+    votes = collections.Counter(convert(record.answer_type, response) for response in record.responses)
+    majority, count = votes.most_common(1)[0]
+    return majority != None and majority == record.expected_answer, count / len(record.responses)
 
-            if answer == None:
-                unparsed.append((question, response))
-            elif answer == q['annotations']['expected_answer']:
-                correct.append((question, response))
+class Summary:
+    """Tallies for the runs of one params key"""
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.examples = collections.defaultdict(list)
+        self.majority_correct = 0
+        self.agreements = []
+
+    def accuracy(self) -> float:
+        graded = self.counts['correct'] + self.counts['incorrect'] + self.counts['unparsed']
+        return self.counts['correct'] / graded if graded > 0 else float('nan')
+
+    def print(self):
+        print('Correct', self.counts['correct'])
+        for q,a in self.examples['correct']: print('   ', q, a)
+        print('Incorrect', self.counts['incorrect'])
+        for q,a in self.examples['incorrect']: print('   ', q, a)
+        print('Unparsed', self.counts['unparsed'])
+        for q,a in self.examples['unparsed']: print('   ', q, a)
+        print('Open questions', self.counts['open'])
+        for p,m,q,a in self.examples['open']: print('   ', p, m, q, a)
+        print('Unanswered', self.counts['unanswered'])
+        if len(self.agreements) > 0:
+            agreements = np.array(self.agreements)
+            print()
+            print(f'Questions with multiple samples {len(agreements)}')
+            print(f'Majority vote correct {self.majority_correct} ({self.majority_correct / len(agreements):.3f})')
+            print(f'Mean agreement {agreements.mean():.3f}, unanimous {(agreements == 1).sum()}')
+            for q,a in self.examples['disagreement']: print('   ', q, f'{a:.2f}')
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        for outcome, examples in other.examples.items():
+            self.examples[outcome].extend(examples)
+        self.majority_correct += other.majority_correct
+        self.agreements.extend(other.agreements)
+
+def params_labels(keys: list[str]) -> dict[str,str]:
+    """Short names for params keys: just the model, unless two keys share a model"""
+    models = {key: json.loads(key)['model'] for key in keys}
+    if len(set(models.values())) == len(keys):
+        return models
+    return {key: key for key in keys}
+
+def print_comparison(summaries: dict[str, Summary], labels: dict[str,str]):
+    rows = [('Correct', lambda s: s.counts['correct']),
+            ('Incorrect', lambda s: s.counts['incorrect']),
+            ('Unparsed', lambda s: s.counts['unparsed']),
+            ('Open questions', lambda s: s.counts['open']),
+            ('Unanswered', lambda s: s.counts['unanswered']),
+            ('Accuracy', lambda s: f'{s.accuracy():.3f}')]
+    if any(len(s.agreements) > 0 for s in summaries.values()):
+        rows += [('Majority vote correct', lambda s: s.majority_correct if len(s.agreements) > 0 else '-'),
+                 ('Mean agreement', lambda s: f'{np.mean(s.agreements):.3f}' if len(s.agreements) > 0 else '-')]
+    print('\t'.join([''] + [labels[key] for key in summaries]))
+    for name, f in rows:
+        print('\t'.join([name] + [str(f(s)) for s in summaries.values()]))
+
+def grade_chunk(data, start:int, end:int, verbosity:int) -> tuple[dict[str, Summary], array.array, MapReconstruction]:
+    """
+    Grade the runs of questions start to end. Return a summary per params key, the outcome of each
+    run as an index into outcomes, and the maps according to the lookup answers.
+    """
+    summaries = {}
+    codes = array.array('b')
+    reconstruction = MapReconstruction(data['maps'])
+    # Only hold on to the individual results that are actually going to be printed
+    listed = {'correct': 2, 'incorrect': 2, 'unparsed': 1, 'open': 1}
+
+    chunk = {'questions': data['questions'][start:end]}
+    for record in iter_records(chunk):
+        outcome, answer = grade_record(record)
+        samples = grade_samples(record)
+        if record.params_key not in summaries:
+            summaries[record.params_key] = Summary()
+        summary = summaries[record.params_key]
+        summary.counts[outcome] += 1
+        codes.append(outcomes.index(outcome))
+        if verbosity >= listed.get(outcome, 3):
+            if outcome == 'open':
+                summary.examples[outcome].append((record.prompt_template, record.map, record.question, record.response))
             else:
-                incorrect.append((question, response))
-
-            if q['map'] == 0:
-                map0.set(question, answer)
-
-    print('Correct', len(correct))
-    if verbosity >= 2:
-        for q,a in correct: print('   ', q, a)
-    print('Incorrect', len(incorrect))
-    if verbosity >= 2:
-        for q,a in incorrect: print('   ', q, a)
-    print('Unparsed', len(unparsed))
-    if verbosity >= 1:
-        for q,a in unparsed: print('   ', q, a)
-    print('Open questions', len(open_questions))
-    if verbosity >= 1:
-        for p,m,q,a in open_questions: print('   ', p, m, q, a)
-    print('Unanswered', len(unanswered))
-    print()
-    print('Original map:')
-    print(data['maps'][0])
-    print()
-    print('Map according to the answers:')
-    print(str(map0))
+                summary.examples[outcome].append((record.question, record.response))
+        if record.answer_type == 'tile' and outcome in ('correct', 'incorrect', 'unparsed'):
+            reconstruction.add(record.map, record.params_key, record.tile or question_tile(record.question), answer)
+        if samples != None:
+            summary.majority_correct += samples[0]
+            summary.agreements.append(samples[1])
+            if verbosity >= 1 and samples[1] < 1:
+                summary.examples['disagreement'].append((record.question, samples[1]))
+    return summaries, codes, reconstruction
+
+# The data being graded by a pool worker. With fork it's inherited rather than sent to each worker.
+_worker_data = None
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+def _grade_chunk_in_worker(args):
+    return grade_chunk(_worker_data, *args)
+
+def grade_chunks(data, verbosity:int, processes:int = 1) -> Iterator[tuple[dict[str, Summary], array.array, MapReconstruction]]:
+    """Grade the questions in order, in one chunk, or split over a process pool if processes > 1"""
+    n = len(data['questions'])
+    if processes <= 1:
+        yield grade_chunk(data, 0, n, verbosity)
+        return
+    # A few chunks per process, so a slow chunk doesn't leave the others idle
+    size = max(1, math.ceil(n / (processes * 4)))
+    chunks = [(start, min(start + size, n), verbosity) for start in range(0, n, size)]
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(data,)) as pool:
+        yield from pool.imap(_grade_chunk_in_worker, chunks)
+
+def grade(data, verbosity:int, processes:int = 1) -> array.array:
+    """
+    Print a summary, side by side if the quiz was run with more than one set of params, and
+    return the outcome of each run (in iter_records order) as an index into outcomes
+    """
+    summaries = {}
+    codes = array.array('b')
+    reconstruction = MapReconstruction(data['maps'])
+
+    for chunk_summaries, chunk_codes, chunk_reconstruction in grade_chunks(data, verbosity, processes):
+        for key, summary in chunk_summaries.items():
+            if key not in summaries:
+                summaries[key] = Summary()
+            summaries[key].merge(summary)
+        codes.extend(chunk_codes)
+        reconstruction.merge(chunk_reconstruction)
+
+    labels = params_labels(list(summaries))
+    if len(summaries) == 1:
+        for summary in summaries.values():
+            summary.print()
+    else:
+        if verbosity >= 1:
+            for key, summary in summaries.items():
+                print(f'== {labels[key]} ==')
+                summary.print()
+                print()
+        print_comparison(summaries, labels)
+
+    tile_errors = TileErrors()
+    for m, key, truth, answers in reconstruction.results():
+        tile_errors.add(answers, truth)
+        label = f'Map {m}' if len(summaries) == 1 else f'Map {m} from {labels[key]}'
+        print()
+        print(f'Original map {m}:')
+        print(str(truth))
+        print(f'{label} according to the answers ({answers.errors(truth).sum()} wrong):')
+        print(str(answers))
+    if len(tile_errors.totals) > 0:
+        print('Per-tile error rate:')
+        print(str(tile_errors))
+    return codes
+
+def convert(typ: str, response: str) -> Optional[str]:
+    if typ == 'bool':
+        return convert_bool(response)
+    elif typ == 'int':
+        return convert_int(response)
+    elif typ == 'tile':
+        return convert_tile(response)
+    else:
+        return None
 
 def convert_bool(response: str) -> Optional[str]:
-    if re_undefined.search(response):
-        return 'undefined'
-    elif re_yes.search(response):
-        return 'yes'
-    elif re_no.search(response):
-        return 'no'
+    m = re_bool.search(response)
+    if m:
+        return m.lastgroup
     else:
         return None
 
 def convert_int(response: str) -> Optional[str]:
-    if re_undefined.search(response):
-        return 'undefined'
+    m = re_int.search(response)
+    if m:
+        return m['int'] or 'undefined'
     else:
-        m = re_int.search(response);
-        if m:
-            return m.group(1)
-        else:
-            return None
+        return None
 
 def convert_tile(response: str) -> Optional[str]:
-    if re_undefined.search(response):
+    words = {m.lastgroup for m in re_tile.finditer(response)}
+    if 'undefined' in words:
         return 'undefined'
+    elif len(words) == 1:
+        return tile_symbols[words.pop()]
     else:
-        stuff = bool(re_wall.search(response)), bool(re_floor.search(response)), bool(re_agent.search(response)), bool(re_goal.search(response))
-        if stuff == (True, False, False, False):
-            return '#'
-        elif stuff == (False, True, False, False):
-            return '.'
-        elif stuff == (False, False, True, False):
-            return '@'
-        elif stuff == (False, False, False, True):
-            return '$'
-        else:
-            return None
+        return None
+
+def wilson_interval(correct: int, n: int, z: float = 1.96) -> tuple[float, float]:
+    """Wilson score interval for an accuracy of correct/n (95% by default)"""
+    p = correct / n
+    denominator = 1 + z*z/n
+    centre = (p + z*z/(2*n)) / denominator
+    spread = z * math.sqrt(p*(1-p)/n + z*z/(4*n*n)) / denominator
+    return centre - spread, centre + spread
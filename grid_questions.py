@@ -1,3 +1,7 @@
+import hashlib
+import json
+from typing import Iterator
+
 def prompt_template():
     return """SETUP: This is Grid World. Don't talk about things unless they can be inferred from the information provided about Grid World.
 
@@ -72,7 +76,8 @@ def map_flames_9x6():
 #....$..#
 #########""".strip()
 
-def get_quiz(params:dict) -> dict:
+def get_quiz(params_list:list[dict]) -> dict:
+    """All the questions, each with one run (params and, once asked, responses) per entry in params_list"""
     questions = _get_all_questions()
     prompt_templates = []
     maps = []
@@ -85,13 +90,68 @@ def get_quiz(params:dict) -> dict:
     for q in questions:
         q['prompt_template'] = prompt_templates.index(q['prompt_template'])
         q['map'] = maps.index(q['map'])
-        q['params'] = params
+        q['runs'] = [{'params': params} for params in params_list]
 
-    return {
+    quiz = {
         'prompt_templates': prompt_templates,
         'maps': maps,
         'questions': questions
     }
+    return quiz
+
+def runs(q: dict) -> list[dict]:
+    """
+    The runs of a question: dicts with params, and response(s) once asked.
+    Older data files have a single run whose fields are stored directly in the question.
+    """
+    if 'runs' in q:
+        return q['runs']
+    else:
+        return [q]
+
+# params -> key, as params_key is called for every run when grading and asking
+_params_keys = {}
+
+def params_key(params: dict) -> str:
+    """Canonical string for a set of params, so that e.g. a stored temperature of 0 matches a parsed 0.0"""
+    items = tuple(params.items())
+    key = _params_keys.get(items)
+    if key == None:
+        key = _params_key(params)
+        _params_keys[items] = key
+    return key
+
+def _params_key(params: dict) -> str:
+    params = dict(params)
+    params['n'] = int(params.get('n', 1))
+    if 'temperature' in params:
+        params['temperature'] = float(params['temperature'])
+    if 'max_tokens' in params:
+        params['max_tokens'] = int(params['max_tokens'])
+    return json.dumps(params, sort_keys=True)
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def question_hash(template_digest: str, map_digest: str, question: str, params: dict) -> str:
+    """Stable hash of everything that goes into asking a question"""
+    h = hashlib.sha256()
+    for part in (template_digest, map_digest, question, params_key(params)):
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()[:32]
+
+def run_hashes(data: dict) -> Iterator[tuple[dict, dict, str]]:
+    """
+    (question, run, hash) for every run. The hash isn't stored in the data file, it's computed
+    from the question's content each time, so it can't go stale when a question is edited.
+    """
+    # The templates and maps are long and shared by many questions, so digest each one once
+    template_digests = [text_digest(t) for t in data['prompt_templates']]
+    map_digests = [text_digest(m) for m in data['maps']]
+    for q in data['questions']:
+        for run in runs(q):
+            yield q, run, question_hash(template_digests[q['prompt_template']], map_digests[q['map']], q['question'], run['params'])
 
 def _get_all_questions() -> list[dict]:
     return (
@@ -174,6 +234,7 @@ def _get_lookup_questions():
             'expected_answer': tile,
             'answer_type': 'tile',
             'importance': 0.0,
+            'tile': [x+1, y+1],
         }
     } for y,row in enumerate(rows) for x,tile in enumerate(row)]
 
@@ -0,0 +1,148 @@
+import argparse
+import numpy as np
+import os
+from typing import Optional
+
+import grid_grading
+import grid_questions
+
+# Columns of the results store. Each one is a NumPy array with one entry per graded run (question and params).
+columns = {
+    'run': str,  # absolute path of the data file that was graded
+    'question': str,
+    'map': np.int32,
+    'prompt_template': np.int32,
+    'answer_type': str,
+    'model': str,
+    'params': str,
+    'importance': np.float32,
+    'outcome': np.int8,
+}
+
+# Outcomes that count towards accuracy. Unparsed answers count as wrong.
+graded_outcomes = [grid_grading.outcomes.index(o) for o in ('correct', 'incorrect', 'unparsed')]
+correct_outcome = grid_grading.outcomes.index('correct')
+
+class ResultsStore:
+    def __init__(self, arrays: Optional[dict] = None):
+        if arrays == None:
+            arrays = {name: np.array([], dtype=typ) for name, typ in columns.items()}
+        self.arrays = arrays
+
+    @classmethod
+    def from_data(cls, data, codes, run:str):
+        """One row per run of each question, in the same order as the codes from grid_grading.grade"""
+        rows = [(q, r) for q in data['questions'] for r in grid_questions.runs(q)]
+        arrays = {
+            'run': np.full(len(rows), run),
+            'question': np.array([q['question'] for q, r in rows], dtype=str),
+            'map': np.array([q['map'] for q, r in rows], dtype=np.int32),
+            'prompt_template': np.array([q['prompt_template'] for q, r in rows], dtype=np.int32),
+            'answer_type': np.array([q['annotations']['answer_type'] for q, r in rows], dtype=str),
+            'model': np.array([r['params']['model'] for q, r in rows], dtype=str),
+            'params': np.array([grid_questions.params_key(r['params']) for q, r in rows], dtype=str),
+            'importance': np.array([q['annotations'].get('importance', 0.0) for q, r in rows], dtype=np.float32),
+            'outcome': np.frombuffer(codes, dtype=np.int8),
+        }
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, filename: str):
+        if not os.path.exists(filename):
+            return cls()
+        with np.load(filename) as f:
+            return cls({name: f[name] for name in columns})
+
+    def save(self, filename: str):
+        # np.savez appends .npz unless it's already there, so write through a file object instead
+        with open(filename, 'wb') as f:
+            np.savez_compressed(f, **self.arrays)
+
+    def __len__(self):
+        return len(self.arrays['outcome'])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def concat(self, other):
+        return ResultsStore({name: np.concatenate([self[name], other[name]]) for name in columns})
+
+    def replace_run(self, other):
+        """Drop any earlier results from the same run(s) as other, then append other"""
+        keep = ~np.isin(self['run'], np.unique(other['run']))
+        return ResultsStore({name: self[name][keep] for name in columns}).concat(other)
+
+    def group(self, by: list[str]) -> tuple[list[tuple], np.ndarray]:
+        """Return the distinct keys for the given columns and, for every row, the index of its key"""
+        inverses = []
+        uniques = []
+        for name in by:
+            u, inv = np.unique(self[name], return_inverse=True)
+            uniques.append(u)
+            inverses.append(inv)
+        if len(by) == 0:
+            return [()], np.zeros(len(self), dtype=np.intp)
+        flat = np.ravel_multi_index(inverses, [len(u) for u in uniques])
+        present, index = np.unique(flat, return_inverse=True)
+        keys = zip(*(u[i] for u, i in zip(uniques, np.unravel_index(present, [len(u) for u in uniques]))))
+        return [tuple(x.item() for x in key) for key in keys], index
+
+    def accuracy(self, by: list[str], bootstrap: int = 1000, alpha: float = 0.05, seed: int = 0) -> list[dict]:
+        """
+        Accuracy, importance-weighted score and a bootstrap confidence interval for each group.
+        Each question counts 1 + importance times in the weighted score, so questions without an
+        importance (0, like all the gradeable ones from get_quiz) still count, just less.
+        """
+        keys, index = self.group(by)
+        graded = np.isin(self['outcome'], graded_outcomes)
+        correct = self['outcome'] == correct_outcome
+        weight = 1 + self['importance'].astype(np.float64)
+
+        n = np.bincount(index, weights=graded, minlength=len(keys))
+        c = np.bincount(index, weights=correct, minlength=len(keys))
+        w = np.bincount(index, weights=weight * graded, minlength=len(keys))
+        wc = np.bincount(index, weights=weight * correct, minlength=len(keys))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            acc = c / n
+            weighted = wc / w
+            # For a 0/1 outcome, resampling n answers with replacement is a binomial draw,
+            # so every group's bootstrap can be done in one batch
+            rng = np.random.default_rng(seed)
+            p = np.nan_to_num(acc)
+            draws = rng.binomial(n.astype(np.int64), p, size=(bootstrap, len(keys))) / n
+            lo, hi = np.quantile(draws, [alpha / 2, 1 - alpha / 2], axis=0)
+
+        return [{
+            'key': key,
+            'graded': int(n[i]),
+            'correct': int(c[i]),
+            'accuracy': acc[i],
+            'weighted': weighted[i],
+            'ci': (lo[i], hi[i]),
+        } for i, key in enumerate(keys)]
+
+def print_table(rows: list[dict], by: list[str]):
+    def fmt(x):
+        return '-' if np.isnan(x) else f'{x:.3f}'
+    print('\t'.join(by + ['graded', 'correct', 'accuracy', 'weighted', 'ci_low', 'ci_high']))
+    for row in rows:
+        print('\t'.join([str(k) for k in row['key']] + [str(row['graded']), str(row['correct']), fmt(row['accuracy']), fmt(row['weighted']), fmt(row['ci'][0]), fmt(row['ci'][1])]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, help='Results store written by grid.py --grade --results')
+    parser.add_argument('--by', type=str, nargs='*', default=['model', 'answer_type'], help=f'Columns to break accuracy down by (default model answer_type). Any of: {", ".join(columns)}')
+    parser.add_argument('--bootstrap', type=int, default=1000, help='Number of bootstrap samples for the confidence interval (default 1000)')
+    parser.add_argument('--alpha', type=float, default=0.05, help='Confidence interval is 1-alpha (default 0.05)')
+    args = parser.parse_args()
+
+    for name in args.by:
+        if name not in columns:
+            raise Exception(f"Unknown column {name}")
+
+    store = ResultsStore.load(args.filename)
+    print_table(store.accuracy(args.by, args.bootstrap, args.alpha), args.by)
+
+if __name__ == '__main__':
+    main()
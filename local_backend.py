@@ -0,0 +1,118 @@
+import collections
+import copy
+import threading
+from typing import Optional
+
+import completions
+
+# Completions from a small causal language model running on the CPU, via transformers.
+#
+# Grid questions share a long few-shot prefix (prompt template and map), and db sessions share
+# everything up to the last database response. So the key/value attention state computed for
+# one prompt is kept, and the next prompt only runs the model over the tokens after the longest
+# prefix it has in common with a cached one.
+
+default_model = 'gpt2'
+
+class LocalBackend:
+    def __init__(self, model_name: str = default_model, cache_size: int = 16):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+        self.torch = torch
+        self.DynamicCache = DynamicCache
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(model_name)
+        self.model.eval()
+        self.cache_size = cache_size
+        # token ids (tuple) -> key/value cache after running the model over exactly those tokens
+        self.cache = collections.OrderedDict()
+        self.reused_tokens = 0
+        self.computed_tokens = 0
+        # grid.py asks from several threads at once. The cache isn't safe to share between them, and
+        # torch already spreads one forward pass over the cores, so requests take turns.
+        self.lock = threading.Lock()
+
+    def __call__(self, prompt: str, max_tokens: int = 16, temperature: float = 0, n: int = 1, stop: Optional[list[str]] = None, **kwargs):
+        with self.lock:
+            return self._complete(prompt, max_tokens, temperature, n, stop)
+
+    def _complete(self, prompt: str, max_tokens: int, temperature: float, n: int, stop: Optional[list[str]]):
+        ids = self.tokenizer(prompt)['input_ids']
+        with self.torch.no_grad():
+            logits, past = self._prefill(ids)
+            texts = []
+            completion_tokens = 0
+            for i in range(n):
+                # The last sample can use the prefilled state itself, the others need their own copy
+                sample_past = past if i == n - 1 else copy.deepcopy(past)
+                text, generated = self._generate(logits, sample_past, max_tokens, temperature, stop or [])
+                texts.append(text)
+                completion_tokens += len(generated)
+                if i == 0 and len(generated) > 0:
+                    # A follow-up prompt will usually continue from this completion
+                    self._remember(ids + generated, sample_past)
+        return completions.Completion(texts, prompt_tokens=len(ids), completion_tokens=completion_tokens)
+
+    def _longest_prefix(self, ids: list[int]) -> tuple[int, Optional[tuple]]:
+        best_length = 0
+        best_key = None
+        for key in self.cache:
+            length = 0
+            for a, b in zip(key, ids):
+                if a != b:
+                    break
+                length += 1
+            if length > best_length:
+                best_length = length
+                best_key = key
+        return best_length, best_key
+
+    def _prefill(self, ids: list[int]):
+        length, key = self._longest_prefix(ids)
+        # Always run at least the last prompt token, to get the logits for the first new token
+        length = min(length, len(ids) - 1)
+        if key != None and length > 0:
+            self.cache.move_to_end(key)
+            past = copy.deepcopy(self.cache[key])
+            if length < len(key):
+                # A negative count means "drop this many" in both old and new transformers releases
+                past.crop(length - len(key))
+        else:
+            length = 0
+            past = self.DynamicCache()
+        self.reused_tokens += length
+        self.computed_tokens += len(ids) - length
+
+        input_ids = self.torch.tensor([ids[length:]])
+        out = self.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+        self._remember(ids, copy.deepcopy(out.past_key_values))
+        return out.logits[0, -1], out.past_key_values
+
+    def _remember(self, ids: list[int], past):
+        self.cache[tuple(ids)] = past
+        self.cache.move_to_end(tuple(ids))
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _generate(self, logits, past, max_tokens: int, temperature: float, stop: list[str]) -> tuple[str, list[int]]:
+        generated = []
+        text = ''
+        for _ in range(max_tokens):
+            if temperature > 0:
+                probs = self.torch.softmax(logits / temperature, dim=-1)
+                token = int(self.torch.multinomial(probs, 1))
+            else:
+                token = int(logits.argmax())
+            if token == self.tokenizer.eos_token_id:
+                break
+            generated.append(token)
+            # Run the token through straight away, so past always covers prompt + generated
+            out = self.model(input_ids=self.torch.tensor([[token]]), past_key_values=past, use_cache=True)
+            logits = out.logits[0, -1]
+            text = self.tokenizer.decode(generated)
+            if any(s in text for s in stop):
+                break
+        for s in stop:
+            if s in text:
+                text = text[:text.index(s)]
+        return text, generated
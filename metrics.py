@@ -0,0 +1,137 @@
+import atexit
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+from typing import Optional
+
+# Latency histogram bucket boundaries in seconds, for the Prometheus snapshot
+buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+usage_fields = ['prompt_tokens', 'completion_tokens', 'total_tokens']
+
+_lock = threading.Lock()
+_durations = {}
+_counters = {}
+_trace_file = None
+_prometheus_filename = None
+_configured = False
+
+def configure(trace: Optional[str] = None, prometheus: Optional[str] = None):
+    """
+    Set where to write the JSONL span trace and the Prometheus text snapshot. Either defaults
+    to the AITEST_TRACE / AITEST_METRICS environment variables, and is off if neither is set.
+    The latency summary is always printed at exit if anything was measured.
+    """
+    global _trace_file, _prometheus_filename, _configured
+    trace = trace or os.getenv('AITEST_TRACE')
+    prometheus = prometheus or os.getenv('AITEST_METRICS')
+    with _lock:
+        if trace and _trace_file == None:
+            _trace_file = open(trace, 'a')
+        if prometheus:
+            _prometheus_filename = prometheus
+        if not _configured:
+            atexit.register(_at_exit)
+            _configured = True
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """
+    Time a block of code, e.g. with metrics.span('request', model=model) as attrs: ...
+    The block can add more entries to attrs, which go into the trace.
+    """
+    start = time.time()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - t0
+        with _lock:
+            _durations.setdefault(name, []).append(duration)
+            if _trace_file != None:
+                line = {'span': name, 'start': start, 'duration': duration, 'thread': threading.get_ident(), **attrs}
+                if error != None:
+                    line['error'] = error
+                _trace_file.write(json.dumps(line) + '\n')
+                _trace_file.flush()
+
+def count(name: str, value: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def record_usage(completion, attrs: Optional[dict] = None) -> dict:
+    """Add the token counts from a completion's usage field to the counters (and to attrs if given)"""
+    usage = getattr(completion, 'usage', None)
+    result = {}
+    if usage != None:
+        for field in usage_fields:
+            value = usage.get(field) if isinstance(usage, dict) else getattr(usage, field, None)
+            if value != None:
+                result[field] = value
+                count(field, value)
+    if attrs != None:
+        attrs.update(result)
+    return result
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summary() -> str:
+    with _lock:
+        durations = {name: sorted(values) for name, values in _durations.items()}
+        counters = dict(_counters)
+    lines = []
+    for name, values in durations.items():
+        p50, p95, p99 = (percentile(values, p) for p in (50, 95, 99))
+        lines.append(f'{name:<10} n={len(values):<6} total={sum(values):.3f}s p50={p50:.3f}s p95={p95:.3f}s p99={p99:.3f}s')
+    for name, value in counters.items():
+        lines.append(f'{name:<10} {value}')
+    return '\n'.join(lines)
+
+def prometheus_text() -> str:
+    with _lock:
+        durations = {name: list(values) for name, values in _durations.items()}
+        counters = dict(_counters)
+    lines = ['# TYPE aitest_span_seconds histogram']
+    for name, values in durations.items():
+        for bound in buckets:
+            lines.append(f'aitest_span_seconds_bucket{{span="{name}",le="{bound}"}} {sum(1 for v in values if v <= bound)}')
+        lines.append(f'aitest_span_seconds_bucket{{span="{name}",le="+Inf"}} {len(values)}')
+        lines.append(f'aitest_span_seconds_sum{{span="{name}"}} {sum(values)}')
+        lines.append(f'aitest_span_seconds_count{{span="{name}"}} {len(values)}')
+    for name, value in counters.items():
+        lines.append(f'# TYPE aitest_{name} counter')
+        lines.append(f'aitest_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+def finish():
+    """Print the latency summary, write the Prometheus snapshot and close the trace"""
+    global _trace_file, _prometheus_filename
+    if len(_durations) > 0 or len(_counters) > 0:
+        print('Timings:')
+        print(summary())
+    if _prometheus_filename != None:
+        with open(_prometheus_filename, 'w') as f:
+            f.write(prometheus_text())
+    with _lock:
+        if _trace_file != None:
+            _trace_file.close()
+        _trace_file = None
+        _prometheus_filename = None
+
+def reset():
+    """Forget everything measured so far, e.g. between jobs in daemon.py"""
+    with _lock:
+        _durations.clear()
+        _counters.clear()
+
+def _at_exit():
+    finish()
@@ -0,0 +1,49 @@
+import math
+
+# Forecasts for --plan: how many completion requests a run will make, roughly how many tokens
+# they use and how long they take. Nothing here calls the completion API.
+
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    """Token count from tiktoken if it's installed, otherwise about four bytes per token"""
+    global _encoding
+    if _encoding == None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('p50k_base')
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text.encode()) / 4)
+
+def wall_time(requests: int, latency: float, concurrency: int, rate_limit: float = 0) -> float:
+    """
+    Seconds to make the requests, each taking latency seconds, with up to concurrency in flight
+    and (if rate_limit > 0) at most rate_limit requests per minute
+    """
+    seconds = math.ceil(requests / concurrency) * latency
+    if rate_limit > 0:
+        seconds = max(seconds, requests / rate_limit * 60)
+    return seconds
+
+def format_seconds(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02}m{seconds:02}s'
+
+def print_plan(requests: int, prompt_tokens: int, completion_tokens: int, latency: float, concurrency: int, rate_limit: float):
+    print(f'Requests {requests}')
+    print(f'Prompt tokens {prompt_tokens} (estimated)')
+    print(f'Completion tokens {completion_tokens} (at most)')
+    print(f'Wall time {format_seconds(wall_time(requests, latency, concurrency, rate_limit))} '
+          f'(at {latency}s per request, concurrency {concurrency}' + (f', {rate_limit} requests/minute)' if rate_limit > 0 else ')'))
+
+def add_arguments(parser, concurrency: bool = True):
+    """concurrency=False for scripts that only ever make one request at a time"""
+    parser.add_argument('--plan', action='store_true', help="Don't call the completion API, just estimate the number of requests, tokens and wall time")
+    parser.add_argument('--latency', type=float, default=2.0, help='Seconds per completion request, for --plan (default 2.0)')
+    if concurrency:
+        parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight at once, per model when asking grid questions (default 1)')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Maximum requests per minute, for --plan (default no limit)')